@@ -7,7 +7,9 @@ import re
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import List, Dict, Optional
+import argparse
 import logging
+import sys
 import time
 
 
@@ -28,12 +30,18 @@ class N8nMonitor:
         self.api_key = config['n8n']['api_key']
         self.git_repo_path = Path(config['git']['repo_path'])
         self.git_remote_url = config['git'].get('remote_url', 'https://github.com/guyu1010/wanin_n8n_bk_data')
+        self.stable_serialization = config['git'].get('stable_serialization', False)
         self.notifications = config.get('notifications', {})
         self.schedule_config = config.get('schedule', {
             'enabled': False,
             'interval': 600,
             'run_on_startup': True
         })
+        self.maintenance_config = config.get('maintenance', {
+            'enabled': False,
+            'interval_hours': 168,
+            'retention_days': 90
+        })
 
         self.headers = {
             'X-N8N-API-KEY': self.api_key,
@@ -258,26 +266,68 @@ class N8nMonitor:
 
         filepath = workflows_dir / filename
         sanitized_workflow = self.sanitize_workflow(workflow)
+        self._write_json(filepath, sanitized_workflow)
+
+        return filepath
+
+    def _serialize_json(self, data) -> str:
+        """序列化 JSON（穩定模式下固定鍵值順序，讓 Git 差異最小化）"""
+        if self.stable_serialization:
+            return json.dumps(data, indent=2, ensure_ascii=False, sort_keys=True) + '\n'
+        return json.dumps(data, indent=2, ensure_ascii=False)
+
+    def _write_json(self, filepath: Path, data) -> bool:
+        """寫入 JSON 檔案，內容未變更時不重寫"""
+        content = self._serialize_json(data)
+        if filepath.exists() and filepath.read_text(encoding='utf-8') == content:
+            return False
 
         with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(sanitized_workflow, f, indent=2, ensure_ascii=False)
+            f.write(content)
+        return True
 
-        return filepath
+    def _normalize_workflow_files(self) -> int:
+        """啟用穩定序列化後一次性改寫既有工作流程檔案，回傳改寫的檔案數"""
+        if not self.stable_serialization:
+            return 0
+
+        marker_file = self._git_path('n8n_stable_serialization')
+        if marker_file.exists():
+            return 0
+
+        workflows_dir = self.git_repo_path / 'workflows'
+
+        rewritten = 0
+        for filepath in sorted(workflows_dir.glob('*.json')):
+            try:
+                data = json.loads(filepath.read_text(encoding='utf-8'))
+            except ValueError:
+                self.logger.warning(f"⚠️ 無法解析 {filepath.name}，略過格式調整")
+                continue
+            if self._write_json(filepath, data):
+                rewritten += 1
+
+        # 改寫後的檔案即使本次提交失敗，也會在下次備份時一併提交
+        marker_file.write_text(datetime.now().isoformat(), encoding='utf-8')
+        if rewritten:
+            self.logger.info(f"✓ 已將 {rewritten} 個工作流程檔案改寫為穩定序列化格式")
+        return rewritten
 
     # ========== Git 操作 ==========
 
-    def _run_git_command(self, cmd: List[str], check: bool = True) -> subprocess.CompletedProcess:
+    def _run_git_command(self, cmd: List[str], check: bool = True,
+                         cwd: Optional[Path] = None) -> subprocess.CompletedProcess:
         """執行 Git 命令"""
         return subprocess.run(
             cmd,
-            cwd=self.git_repo_path,
+            cwd=cwd or self.git_repo_path,
             check=check,
             capture_output=True,
             text=True,
             encoding='utf-8'
         )
 
-    def git_commit_and_push(self, changed_workflows: List[str]) -> bool:
+    def git_commit_and_push(self, changed_workflows: List[str], normalized_count: int = 0) -> bool:
         """提交變更到 Git"""
         try:
             # Git add
@@ -293,7 +343,11 @@ class N8nMonitor:
 
             # Commit
             timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            commit_msg = f"[自動備份] {timestamp}\n\n變更的工作流程:\n" + "\n".join(f"- {name}" for name in changed_workflows)
+            commit_msg = f"[自動備份] {timestamp}"
+            if changed_workflows:
+                commit_msg += "\n\n變更的工作流程:\n" + "\n".join(f"- {name}" for name in changed_workflows)
+            if normalized_count:
+                commit_msg += f"\n\n穩定序列化格式調整: {normalized_count} 個檔案"
 
             self._run_git_command(['git', 'commit', '-m', commit_msg])
 
@@ -301,7 +355,10 @@ class N8nMonitor:
             for retry in range(3):
                 try:
                     self._run_git_command(['git', 'push'])
-                    self.logger.info(f"✓ 成功推送 {len(changed_workflows)} 個工作流程到 Git")
+                    if changed_workflows:
+                        self.logger.info(f"✓ 成功推送 {len(changed_workflows)} 個工作流程到 Git")
+                    if normalized_count:
+                        self.logger.info(f"✓ 成功推送 {normalized_count} 個檔案的格式調整到 Git")
                     return True
 
                 except subprocess.CalledProcessError as e:
@@ -332,6 +389,170 @@ class N8nMonitor:
             self.logger.error(f"✗ Git 操作發生錯誤: {e}")
             return False
 
+    # ========== 儲存庫維護 ==========
+
+    def _git_path(self, name: str) -> Path:
+        """取得 .git 目錄內的檔案路徑（不會被提交）"""
+        result = self._run_git_command(['git', 'rev-parse', '--git-path', name])
+        return self.git_repo_path / result.stdout.strip()
+
+    def should_run_maintenance(self) -> bool:
+        """檢查是否到達維護時間"""
+        if not self.maintenance_config.get('enabled', False):
+            return False
+
+        try:
+            state_file = self._git_path('n8n_maintenance.json')
+        except (subprocess.CalledProcessError, OSError):
+            return False
+
+        if not state_file.exists():
+            return True
+
+        try:
+            state = json.load(open(state_file, 'r', encoding='utf-8'))
+            last_run = datetime.fromisoformat(state['last_run'])
+        except (ValueError, KeyError, TypeError, OSError):
+            # 狀態檔損毀時直接執行維護，並於完成後重寫
+            return True
+        interval = timedelta(hours=self.maintenance_config.get('interval_hours', 168))
+        return datetime.now() - last_run >= interval
+
+    def _archive_history(self, cutoff: datetime) -> Dict:
+        """將保留期限以前的歷史封存為快照 tag 與 bundle"""
+        archived = {'snapshot_tag': None, 'bundle': None}
+        tag_prefix = self.maintenance_config.get('tag_prefix', 'snapshot/')
+
+        shallow = self._run_git_command(['git', 'rev-parse', '--is-shallow-repository'])
+        if shallow.stdout.strip() == 'true':
+            self.logger.info("ℹ️ 淺層 clone 無完整歷史，略過封存（請在擁有完整歷史的主機執行）")
+            return archived
+
+        # 保留期限前的最後一個提交
+        boundary = self._run_git_command(
+            ['git', 'rev-list', '-1', f"--before={cutoff.isoformat()}", 'HEAD'], check=False
+        ).stdout.strip()
+        if not boundary:
+            return archived
+
+        tagged = self._run_git_command(['git', 'tag', '--points-at', boundary, '--list', f"{tag_prefix}*"])
+        if tagged.stdout.strip():
+            tag_name = tagged.stdout.split()[0]
+        else:
+            commit_date = self._run_git_command(
+                ['git', 'log', '-1', '--format=%cd', '--date=format:%Y%m%d-%H%M%S', boundary]
+            ).stdout.strip()
+            tag_name = f"{tag_prefix}{commit_date}"
+
+        archive_dir = Path(self.maintenance_config.get('archive_dir', './archives')).resolve()
+        archive_dir.mkdir(parents=True, exist_ok=True)
+
+        if not tagged.stdout.strip():
+            self._run_git_command(['git', 'tag', '-a', tag_name, '-m', f"[歷史快照] {cutoff.strftime('%Y-%m-%d')} 以前的備份", boundary])
+            archived['snapshot_tag'] = tag_name
+
+        # 每個快照 tag 都需要對應的 bundle，補建缺少的部分以維持增量鏈完整
+        snapshot_tags = self._run_git_command(
+            ['git', 'for-each-ref', '--sort=*committerdate', '--format=%(refname:short)', f"refs/tags/{tag_prefix}*"]
+        ).stdout.split()
+        for snapshot_tag in snapshot_tags:
+            bundle_path = archive_dir / f"{snapshot_tag.replace('/', '_')}.bundle"
+            if bundle_path.exists():
+                continue
+
+            try:
+                self._create_snapshot_bundle(snapshot_tag, bundle_path, tag_prefix)
+            except (subprocess.CalledProcessError, OSError):
+                # 新建的 tag 沒有 bundle 時移除，維持「tag 存在即 bundle 已完成」
+                if snapshot_tag == archived['snapshot_tag']:
+                    self._run_git_command(['git', 'tag', '-d', snapshot_tag], check=False)
+                raise
+
+            if snapshot_tag == tag_name:
+                archived['bundle'] = str(bundle_path)
+            else:
+                self.logger.info(f"✓ 已補建遺失的 bundle: {bundle_path.name}")
+
+        # 推送所有快照 tag，補上先前推送失敗的部分；失敗時由呼叫端視為維護失敗
+        self._run_git_command(['git', 'push', 'origin', f"refs/tags/{tag_prefix}*:refs/tags/{tag_prefix}*"])
+
+        return archived
+
+    def _create_snapshot_bundle(self, snapshot_tag: str, bundle_path: Path, tag_prefix: str):
+        """建立快照的增量 bundle（從上一個快照開始；沒有上一個快照時為完整歷史）"""
+        previous = self._run_git_command(
+            ['git', 'describe', '--tags', '--abbrev=0', '--match', f"{tag_prefix}*", f"{snapshot_tag}^"], check=False
+        ).stdout.strip()
+        rev_range = f"{previous}..{snapshot_tag}" if previous else snapshot_tag
+
+        tmp_path = bundle_path.with_name(bundle_path.name + '.tmp')
+        self._run_git_command(['git', 'bundle', 'create', str(tmp_path), rev_range])
+        tmp_path.replace(bundle_path)
+
+    def maintain_repository(self) -> Dict:
+        """執行儲存庫維護：封存舊歷史並重新打包"""
+        result = {
+            'success': False,
+            'snapshot_tag': None,
+            'bundle': None,
+            'error': None
+        }
+
+        try:
+            cutoff = datetime.now() - timedelta(days=self.maintenance_config.get('retention_days', 90))
+            result.update(self._archive_history(cutoff))
+
+            # 重新打包，讓相近版本的 JSON 以 delta 儲存
+            self._run_git_command([
+                'git', 'repack', '-a', '-d', '-q',
+                f"--window={self.maintenance_config.get('repack_window', 250)}",
+                f"--depth={self.maintenance_config.get('repack_depth', 50)}"
+            ])
+
+            with open(self._git_path('n8n_maintenance.json'), 'w', encoding='utf-8') as f:
+                json.dump({'last_run': datetime.now().isoformat()}, f, indent=2)
+
+            result['success'] = True
+            if result['snapshot_tag']:
+                self.logger.info(f"✓ 儲存庫維護完成，已封存至 {result['snapshot_tag']} ({result['bundle']})")
+            else:
+                self.logger.info("✓ 儲存庫維護完成")
+
+        except subprocess.CalledProcessError as e:
+            result['error'] = f"{e.cmd} (返回碼: {e.returncode})"
+            self.logger.error(f"✗ 儲存庫維護失敗: {result['error']}")
+        except Exception as e:
+            result['error'] = str(e)
+            self.logger.error(f"✗ 儲存庫維護發生錯誤: {e}")
+
+        return result
+
+    def clone_recent(self, target_path: str, days: Optional[int] = None) -> bool:
+        """僅 clone 近期歷史的備份 Repository（用於新主機還原）"""
+        if days is None:
+            days = self.maintenance_config.get('retention_days', 90)
+        since = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+        target = Path(target_path).resolve()
+        target.parent.mkdir(parents=True, exist_ok=True)
+        base_cmd = ['git', 'clone', '--single-branch', '--branch', 'main', '--no-tags']
+
+        try:
+            self._run_git_command(
+                base_cmd + [f"--shallow-since={since}", self.git_remote_url, str(target)], cwd=target.parent
+            )
+        except subprocess.CalledProcessError:
+            # 期限內沒有提交時，至少取得最新版本
+            try:
+                self._run_git_command(
+                    base_cmd + ['--depth', '1', self.git_remote_url, str(target)], cwd=target.parent
+                )
+            except subprocess.CalledProcessError as e:
+                self.logger.error(f"✗ Clone 失敗: {e.stderr.strip()}")
+                return False
+
+        self.logger.info(f"✓ 已 clone 近 {days} 天的備份歷史到 {target}")
+        return True
+
     # ========== 備份流程 ==========
 
     def backup_workflows(self) -> Dict:
@@ -364,6 +585,9 @@ class N8nMonitor:
         new_workflows = {}
         changed_workflows = []
 
+        # 啟用穩定序列化後一次性改寫既有檔案，避免之後每次變更都出現整份重排的差異
+        normalized_count = self._normalize_workflow_files()
+
         # 處理每個工作流程
         for workflow in workflows:
             detail = self.get_workflow_detail(workflow['id'])
@@ -398,19 +622,23 @@ class N8nMonitor:
                     changed_workflows.append(workflow_name)
 
         # 儲存新的 hash 和資料
-        with open(hash_file, 'w', encoding='utf-8') as f:
-            json.dump(new_hashes, f, indent=2)
+        self._write_json(hash_file, new_hashes)
 
-        sanitized_workflows = {wid: self.sanitize_workflow(wdata) for wid, wdata in new_workflows.items()}
-        with open(data_file, 'w', encoding='utf-8') as f:
-            json.dump(sanitized_workflows, f, indent=2, ensure_ascii=False)
+        sanitized_workflows = {}
+        for wid, wdata in new_workflows.items():
+            if self.stable_serialization and wid in old_workflows and old_hashes.get(wid) == new_hashes[wid]:
+                # 功能未變更時沿用舊紀錄，避免位置、時間戳等欄位造成無意義的提交
+                sanitized_workflows[wid] = old_workflows[wid]
+            else:
+                sanitized_workflows[wid] = self.sanitize_workflow(wdata)
+        self._write_json(data_file, sanitized_workflows)
 
         result['changed_count'] = len(changed_workflows)
         result['changed_workflows'] = changed_workflows
 
         # 提交到 Git
-        if changed_workflows:
-            if self.git_commit_and_push(changed_workflows):
+        if changed_workflows or normalized_count:
+            if self.git_commit_and_push(changed_workflows, normalized_count):
                 result['success'] = True
             else:
                 result['error'] = 'Git 提交失敗'
@@ -591,6 +819,11 @@ class N8nMonitor:
         else:
             self.logger.warning("⚠️ 服務異常，跳過備份")
 
+        # 定期維護備份 Repository
+        if self.should_run_maintenance():
+            self.logger.info("🧹 開始維護備份 Repository...")
+            self.maintain_repository()
+
     def run_scheduled(self):
         """執行排程模式"""
         run_on_startup = self.schedule_config.get('run_on_startup', True)
@@ -650,9 +883,23 @@ class N8nMonitor:
 
 
 if __name__ == '__main__':
-    monitor = N8nMonitor('config.json')
-
-    if monitor.schedule_config.get('enabled', False):
+    parser = argparse.ArgumentParser(description='n8n 工作流程監控與備份系統')
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'maintain', 'clone'],
+                        help='run: 監控與備份 | maintain: 立即維護備份 Repository | clone: 僅 clone 近期歷史')
+    parser.add_argument('target', nargs='?', help='clone 的目標路徑（預設為 git.repo_path）')
+    parser.add_argument('--days', type=int, help='clone 保留的天數（預設為 maintenance.retention_days）')
+    parser.add_argument('--config', default='config.json', help='設定檔路徑')
+    args = parser.parse_args()
+
+    monitor = N8nMonitor(args.config)
+
+    if args.command == 'maintain':
+        if not monitor.maintain_repository()['success']:
+            sys.exit(1)
+    elif args.command == 'clone':
+        if not monitor.clone_recent(args.target or str(monitor.git_repo_path), args.days):
+            sys.exit(1)
+    elif monitor.schedule_config.get('enabled', False):
         monitor.run_scheduled()
     else:
         monitor.run()